@@ -1,65 +1,118 @@
 import logging
 import asyncio
-import requests
+import os
+import sys
+import time
+import aiosqlite
 from datetime import timedelta
-from collections import defaultdict
+from typing import Optional
+from collections import OrderedDict
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, ContextTypes,
     PollAnswerHandler
 )
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # === 設定 ===
 BOT_TOKEN = ""
 GROUP_CHAT_ID = ""
 POLL_OPTIONS = ["🏀 打", "❌ nope"]
 RADAR_IMAGE_URL = "https://www.cwa.gov.tw/Data/radar/CV1_3600.png"  # 中央氣象局雷達圖
+RADAR_CACHE_TTL = 300  # 秒；雷達圖約每 10 分鐘更新一次
+POLL_VOTES_MAX_AGE = 24 * 60 * 60  # 秒；超過此時間的投票紀錄會被清除
+VOTE_DEBOUNCE = 0.2  # 秒；同一使用者在此時間內的連續改票只記錄最後一次
+USER_NAME_CACHE_SIZE = 10000  # 顯示名稱快取上限，超過時淘汰最久未投票的使用者
+USER_NAME_MAX_LEN = 64  # 顯示名稱最長字數
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "state.db")  # 投票狀態存放於 SQLite（data/ 為掛載目錄），重啟後可繼續進行中的投票
 
 # === 儲存資料 ===
-poll_answers = defaultdict(lambda: defaultdict(list))  # {poll_id: {option_index: [user_id]}}
-user_display_names = {}  # {user_id: 顯示名稱}
-active_poll_info = {"message_id": None, "poll_id": None}
+# 投票（poll_vote）、顯示名稱（user_name）、進行中投票（active_poll）存於 SQLite
+DB: Optional[aiosqlite.Connection] = None  # 於 post_init 開啟
+user_display_names: "OrderedDict[int, str]" = OrderedDict()  # {user_id: 顯示名稱}；LRU 寫入快取，避免重複寫入 user_name
+active_poll_info = {"message_id": None, "poll_id": None}  # active_poll 的記憶體副本
+POLL_LOCK: Optional[asyncio.Lock] = None  # 避免同時發起／結束投票，於 post_init 建立
+latest_votes = {}  # {user_id: (poll_id, option_ids, 顯示名稱)}；等待寫入的最新選擇
+pending_votes: dict[int, asyncio.TimerHandle] = {}  # {user_id: 延遲寫入的 timer}
+_bg_tasks: set[asyncio.Task] = set()  # 保留背景寫入 task 的參照，避免被回收
+_radar_cache = {"file_id": None, "fetched_at": 0.0}
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS active_poll (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    poll_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS poll_vote (
+    poll_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    option_index INTEGER NOT NULL,
+    voted_at REAL NOT NULL,
+    PRIMARY KEY (poll_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS user_name (
+    user_id INTEGER PRIMARY KEY,
+    display TEXT NOT NULL
+);
+"""
 
 # === Logging 設定 ===
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
 )
+logger = logging.getLogger(__name__)
 
-# === /wea 指令：發送雷達圖 ===
+# === /wea 指令：發送雷達圖（由 Telegram 直接抓取，並快取 file_id） ===
 async def wea_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    caption = "🌧️ 台灣雷達回波圖"
     try:
-        response = requests.get(RADAR_IMAGE_URL)
-        if response.status_code == 200:
-            await update.message.reply_photo(photo=response.content, caption="🌧️ 台灣雷達回波圖")
-        else:
-            await update.message.reply_text("⚠️ 圖片載入失敗，請稍後再試。")
+        now = time.time()
+        file_id = _radar_cache["file_id"]
+        if file_id and now - _radar_cache["fetched_at"] < RADAR_CACHE_TTL:
+            await update.message.reply_photo(photo=file_id, caption=caption)
+            return
+
+        # Telegram 會依 URL 快取圖片，加上時間參數確保拿到最新的雷達圖
+        url = f"{RADAR_IMAGE_URL}?t={int(now // RADAR_CACHE_TTL)}"
+        message = await update.message.reply_photo(photo=url, caption=caption)
+        _radar_cache["file_id"] = message.photo[-1].file_id
+        _radar_cache["fetched_at"] = now
+    except BadRequest as e:
+        logger.error("雷達圖載入失敗：%s", e)
+        await update.message.reply_text("⚠️ 圖片載入失敗，請稍後再試。")
     except Exception as e:
-        logging.error(f"錯誤：{e}")
+        logger.error("錯誤：%s", e)
         await update.message.reply_text("⚠️ 發生錯誤，請稍後再試。")
 
 # === 發起投票 ===
 async def start_poll_by_bot(bot):
-    if active_poll_info["poll_id"] is not None:
-        logging.warning("⚠️ 已有一個投票進行中，跳過新投票")
+    async with POLL_LOCK:
+        if active_poll_info["poll_id"] is not None:
+            logger.warning("⚠️ 已有一個投票進行中，跳過新投票")
 
-        try:
-            # 嘗試發送提示訊息（排程不一定有 chat context）
-            await bot.send_message(chat_id=GROUP_CHAT_ID, text="⚠️ 已有一個投票進行中，請先結束再發起新投票")
-        except Exception as e:
-            logging.info(f"排程模式下跳過發送訊息：{e}")
-        return
+            try:
+                # 嘗試發送提示訊息（排程不一定有 chat context）
+                await bot.send_message(chat_id=GROUP_CHAT_ID, text="⚠️ 已有一個投票進行中，請先結束再發起新投票")
+            except Exception as e:
+                logger.info("排程模式下跳過發送訊息：%s", e)
+            return
 
-    message = await bot.send_poll(
-        chat_id=GROUP_CHAT_ID,
-        question="wanna play?",
-        options=POLL_OPTIONS,
-        is_anonymous=False,
-        allows_multiple_answers=False,
-    )
-    active_poll_info["message_id"] = message.message_id
-    active_poll_info["poll_id"] = message.poll.id
-    logging.info(f"✅ 發起投票：{message.poll.id}")
+        message = await bot.send_poll(
+            chat_id=GROUP_CHAT_ID,
+            question="wanna play?",
+            options=POLL_OPTIONS,
+            is_anonymous=False,
+            allows_multiple_answers=False,
+        )
+        active_poll_info["message_id"] = message.message_id
+        active_poll_info["poll_id"] = message.poll.id
+        await DB.execute(
+            "INSERT OR REPLACE INTO active_poll(id, poll_id, message_id) VALUES(1, ?, ?)",
+            (message.poll.id, message.message_id),
+        )
+        await DB.commit()
+        logger.info("✅ 發起投票：%s", message.poll.id)
 
 # === 投票紀錄 ===
 async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -68,50 +121,133 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = user.id
     selected = update.poll_answer.option_ids
 
-    # 儲存顯示名稱
-    user_display_names[user_id] = f"@{user.username}" if user.username else user.full_name
+    # 只記錄進行中的投票，忽略已結束或未知投票的更新
+    if poll_id != active_poll_info["poll_id"]:
+        return
 
-    # 移除舊選擇
-    for opt_index in poll_answers[poll_id]:
-        if user_id in poll_answers[poll_id][opt_index]:
-            poll_answers[poll_id][opt_index].remove(user_id)
+    name = sys.intern(f"@{user.username}" if user.username else user.full_name[:USER_NAME_MAX_LEN])
 
-    # 加入新選擇
-    for i in selected:
-        poll_answers[poll_id][i].append(user_id)
+    # 合併短時間內的連續改票：只寫入最後一次選擇
+    latest_votes[user_id] = (poll_id, selected, name)
+    handle = pending_votes.get(user_id)
+    if handle is not None:
+        handle.cancel()
+    pending_votes[user_id] = asyncio.get_running_loop().call_later(
+        VOTE_DEBOUNCE, _flush_vote, user_id
+    )
 
-    logging.info(f"📥 {user_display_names[user_id]} 投了選項 {selected}")
+def _flush_vote(user_id):
+    pending_votes.pop(user_id, None)
+    poll_id, selected, name = latest_votes.pop(user_id)
+    if poll_id != active_poll_info["poll_id"]:
+        return  # 等待期間投票已結束
+    task = asyncio.ensure_future(_record_vote(poll_id, user_id, selected, name))
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+
+async def _record_vote(poll_id, user_id, selected, name):
+    try:
+        # 儲存顯示名稱（只在新使用者或名稱變更時寫入）
+        if user_display_names.get(user_id) != name:
+            await DB.execute(
+                "INSERT OR REPLACE INTO user_name(user_id, display) VALUES(?, ?)", (user_id, name)
+            )
+            user_display_names[user_id] = name
+            if len(user_display_names) > USER_NAME_CACHE_SIZE:
+                user_display_names.popitem(last=False)
+        user_display_names.move_to_end(user_id)
+
+        # 單選投票：(poll_id, user_id) 為主鍵，直接覆蓋舊選擇；收回投票則刪除
+        if selected:
+            await DB.execute(
+                "INSERT OR REPLACE INTO poll_vote(poll_id, user_id, option_index, voted_at) VALUES(?, ?, ?, ?)",
+                (poll_id, user_id, selected[0], time.time()),
+            )
+        else:
+            await DB.execute(
+                "DELETE FROM poll_vote WHERE poll_id = ? AND user_id = ?", (poll_id, user_id)
+            )
+        await DB.commit()
+    except Exception as e:
+        logger.error("❌ 投票紀錄失敗：%s", e)
+        return
+
+    logger.info("📥 %s 投了選項 %s", name, selected)
+
+# === 立即寫入所有尚未寫入的投票（關閉投票後、統計前呼叫） ===
+async def flush_pending_votes():
+    for user_id, handle in list(pending_votes.items()):
+        handle.cancel()
+        _flush_vote(user_id)
+    if _bg_tasks:
+        await asyncio.gather(*_bg_tasks)
+
+# === 投票結果文字：rows 為 (option_index, 顯示名稱) ===
+def _build_summary(result, rows):
+    counts = [[] for _ in result.options]
+    for idx, display in rows:
+        counts[idx].append(display or "未知")
+
+    parts = [f"📊 投票結果：「{result.question}」", ""]
+    for option, names in zip(result.options, counts):
+        parts.append(f"{option.text}（{len(names)}人）：{'、'.join(names) or '無'}")
+    return "\n".join(parts)
 
 # === 結束投票 ===
 async def stop_poll_by_bot(bot):
-    poll_id = active_poll_info["poll_id"]
-    message_id = active_poll_info["message_id"]
+    async with POLL_LOCK:
+        poll_id = active_poll_info["poll_id"]
+        message_id = active_poll_info["message_id"]
 
-    if not poll_id or not message_id:
-        logging.warning("⚠️ 無投票進行中，跳過結束")
-        return
+        if not poll_id or not message_id:
+            logger.warning("⚠️ 無投票進行中，跳過結束")
+            return
 
-    try:
-        result = await bot.stop_poll(
-            chat_id=GROUP_CHAT_ID,
-            message_id=message_id,
-        )
+        try:
+            result = await bot.stop_poll(
+                chat_id=GROUP_CHAT_ID,
+                message_id=message_id,
+            )
 
-        summary = f"📊 投票結果：「{result.question}」\n\n"
-        for i, option in enumerate(result.options):
-            user_ids = poll_answers[poll_id].get(i, [])
-            names = [user_display_names.get(uid, "未知") for uid in user_ids]
-            summary += f"{option.text}（{len(user_ids)}人）：{'、'.join(names) or '無'}\n"
+            # 投票已關閉，寫入仍在等待合併的選擇後再統計
+            await flush_pending_votes()
 
-        await bot.send_message(chat_id=GROUP_CHAT_ID, text=summary)
+            rows = await DB.execute_fetchall(
+                "SELECT v.option_index, n.display FROM poll_vote v"
+                " LEFT JOIN user_name n USING (user_id)"
+                " WHERE v.poll_id = ? ORDER BY v.voted_at",
+                (poll_id,),
+            )
 
-        # 清除資料
-        del poll_answers[poll_id]
-        active_poll_info["poll_id"] = None
-        active_poll_info["message_id"] = None
+            # 組字串移到 worker thread，避免投票人數多時卡住 event loop
+            summary = await asyncio.to_thread(_build_summary, result, rows)
 
-    except Exception as e:
-        logging.error(f"❌ 結束投票失敗：{e}")
+            await bot.send_message(chat_id=GROUP_CHAT_ID, text=summary)
+
+        except Exception as e:
+            logger.error("❌ 結束投票失敗：%s", e)
+
+        finally:
+            # 清除資料（即使失敗也要清，避免殘留）
+            active_poll_info["poll_id"] = None
+            active_poll_info["message_id"] = None
+            if _bg_tasks:
+                # 等候清除前已開始的寫入完成，之後的更新都會被忽略
+                await asyncio.gather(*_bg_tasks)
+            await DB.execute("DELETE FROM poll_vote WHERE poll_id = ?", (poll_id,))
+            await DB.execute("DELETE FROM active_poll")
+            await DB.commit()
+
+# === 定期清除過期的投票紀錄 ===
+async def sweep_poll_votes():
+    cutoff = time.time() - POLL_VOTES_MAX_AGE
+    cursor = await DB.execute(
+        "DELETE FROM poll_vote WHERE voted_at < ? AND poll_id IS NOT ?",
+        (cutoff, active_poll_info["poll_id"]),
+    )
+    await DB.commit()
+    if cursor.rowcount:
+        logger.info("🧹 清除 %s 筆過期投票紀錄", cursor.rowcount)
 
 # === /start 指令 ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -124,32 +260,71 @@ async def poll_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await start_poll_by_bot(context.bot)
 
-# === 主程式 ===
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("wea", wea_handler))
-    app.add_handler(PollAnswerHandler(handle_poll_answer))
-    app.add_handler(CommandHandler("poll", poll_handler))
-    # 測試用手動發起、結束投票指令
-    app.add_handler(CommandHandler("poll", lambda update, context: asyncio.create_task(start_poll_by_bot(context.bot))))
-    app.add_handler(CommandHandler("close", lambda update, context: asyncio.create_task(stop_poll_by_bot(context.bot))))
+# === 處理結束投票指令 ===
+async def close_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await stop_poll_by_bot(context.bot)
+
+# === 啟動：在 PTB 的 event loop 啟動後開啟資料庫與排程器 ===
+async def post_init(app):
+    global DB, POLL_LOCK
+    POLL_LOCK = asyncio.Lock()
 
-    # === 建立排程器 ===
-    scheduler = BackgroundScheduler(timezone="Asia/Taipei")
-    loop = asyncio.get_event_loop()
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    DB = await aiosqlite.connect(DB_PATH)
+    await DB.execute("PRAGMA journal_mode=WAL")
+    await DB.executescript(DB_SCHEMA)
+    await DB.commit()
+
+    # 還原重啟前進行中的投票
+    async with DB.execute("SELECT poll_id, message_id FROM active_poll WHERE id = 1") as cursor:
+        row = await cursor.fetchone()
+    if row:
+        active_poll_info["poll_id"], active_poll_info["message_id"] = row
+        logger.info("♻️ 還原進行中的投票：%s", row[0])
+
+    scheduler = AsyncIOScheduler(event_loop=asyncio.get_running_loop(), timezone="Asia/Taipei")
 
     scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(start_poll_by_bot(app.bot), loop),
+        start_poll_by_bot, args=[app.bot],
         trigger="cron", day_of_week="sun", hour=18, minute=0,
     )
 
     scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(stop_poll_by_bot(app.bot), loop),
+        stop_poll_by_bot, args=[app.bot],
         trigger="cron", day_of_week="mon", hour=7, minute=0,
     )
 
+    scheduler.add_job(sweep_poll_votes, trigger="interval", hours=1)
+
     scheduler.start()
+    app.bot_data["scheduler"] = scheduler
+
+# === 關閉：停止排程器，關閉資料庫 ===
+async def post_shutdown(app):
+    scheduler = app.bot_data.get("scheduler")
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+    if DB is not None:
+        await flush_pending_votes()
+        await DB.close()
+
+# === 主程式 ===
+def main():
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(32)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("wea", wea_handler))
+    app.add_handler(PollAnswerHandler(handle_poll_answer))
+    app.add_handler(CommandHandler("poll", poll_handler))
+    # 測試用手動結束投票指令
+    app.add_handler(CommandHandler("close", close_handler))
+
     app.run_polling()
 
 if __name__ == "__main__":